@@ -151,7 +151,7 @@ class Dataset():
         # For each subsequence from `start_index` to `start_index + i`, where i = 1, 2, ..., `max_length`, the label is `start_index + i + 1`, which denotes the next character.
         labels = torch.stack([data[index+1:index+self.max_length+1] for index in start_indices])
         # Move the tensors to the device and return
-        return inputs.to(self.device), labels.to(self.device)
+        return self.move_to_device(inputs, labels)
 
     def get_batch_generator_finetune(self, split: str) -> Generator[tuple[Tensor, Tensor], None, None]:
         """
@@ -180,11 +180,11 @@ class Dataset():
                 # Reset the batch for the next iteration
                 batch = []
                 # Return a batch of inputs and labels to the caller
-                yield inputs.to(self.device), labels.to(self.device)
+                yield self.move_to_device(inputs, labels)
         # If there are still remaining items, process them and yield
         if len(batch) > 0:
             inputs, labels = self.process_batch(batch)
-            yield inputs.to(self.device), labels.to(self.device)
+            yield self.move_to_device(inputs, labels)
 
     def get_batch_generator_alignment(self, split: str) -> Generator[tuple[Tensor, Tensor, Tensor, Tensor], None, None]:
         """
@@ -219,12 +219,30 @@ class Dataset():
                 # Reset the batch for the next iteration
                 batch = []
                 # Return a batch of inputs and labels to the caller
-                yield positive_inputs.to(self.device), positive_labels.to(self.device), negative_inputs.to(self.device), negative_labels.to(self.device)
+                yield self.move_to_device(positive_inputs, positive_labels, negative_inputs, negative_labels)
         # If there are still remaining items, process them and yield
         if len(batch) > 0:
             positive_inputs, positive_labels = self.process_batch([item[0] for item in batch])
             negative_inputs, negative_labels = self.process_batch([item[1] for item in batch])
-            yield positive_inputs.to(self.device), positive_labels.to(self.device), negative_inputs.to(self.device), negative_labels.to(self.device)
+            yield self.move_to_device(positive_inputs, positive_labels, negative_inputs, negative_labels)
+
+    def move_to_device(self, *tensors: Tensor) -> tuple[Tensor, ...]:
+        """
+        Move a batch of tensors to the device.
+
+        On GPU, the tensors are first put in page-locked (pinned) memory so that they can be copied
+        asynchronously. The copy then overlaps with the computation already queued on the GPU
+        instead of blocking the training loop.
+
+        Args:
+            tensors: The tensors of a batch, prepared on CPU.
+
+        Returns:
+            The same tensors on the device.
+        """
+        if self.device == 'cuda':
+            return tuple(tensor.pin_memory().to(self.device, non_blocking=True) for tensor in tensors)
+        return tuple(tensor.to(self.device) for tensor in tensors)
 
     def process_batch(self, batch: list) -> tuple[Tensor, Tensor]:
         """
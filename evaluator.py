@@ -1,7 +1,7 @@
 import torch
 
 from dataset import Dataset
-from model import DpoWrapper, TutorialLLM
+from model import DpoWrapper, TutorialLLM, get_autocast_config
 
 class Evaluator():
     """
@@ -28,8 +28,13 @@ class Evaluator():
         self.interval_to_evaluate_pretrain = interval_to_evaluate_pretrain
         self.interval_to_evaluate_finetune = interval_to_evaluate_finetune
         self.interval_to_evaluate_alignment = interval_to_evaluate_alignment
+        # Evaluate with the same mixed precision as the trainer on GPU
+        self.use_autocast, self.autocast_dtype = get_autocast_config(device)
 
         self.test_input = '<INS>請用以下題目寫一首詩<INP>春夜喜雨<RES>'
+        # Tokenize the prompts for generation once and keep them on the device for all evaluations
+        self.pretrain_test_tokens = torch.tensor(self.dataset.encode('春夜喜雨'), dtype=torch.long, device=self.device).unsqueeze(0)
+        self.test_tokens = torch.tensor(self.dataset.encode(self.test_input), dtype=torch.long, device=self.device).unsqueeze(0)
 
         self.reset()
     
@@ -62,9 +67,8 @@ class Evaluator():
             print(f"Step {iteration}, train loss {mean_loss_train:.4f}, evaluate loss {evaluate_loss:.4f}")
 
             # Let's generate a poem starting with the title '春夜喜雨' to see how the model is doing
-            test_tokens = torch.tensor(self.dataset.encode('春夜喜雨'), dtype=torch.long, device=self.device).unsqueeze(0)
             print('Generate first 100 characters of poems starting with 春夜喜雨:')
-            print(self.dataset.decode(model.generate(test_tokens, max_new_tokens=100)[0].tolist()))
+            print(self.dataset.decode(model.generate(self.pretrain_test_tokens, max_new_tokens=100)[0].tolist()))
         
         # Accumulate the training loss
         self.train_loss_sum += train_loss
@@ -86,7 +90,8 @@ class Evaluator():
         for k in range(iterations):
             # Get a batch of pretrain data and compute the loss
             inputs, labels = self.dataset.get_batch_pretrain('evaluate')
-            _, loss = model(inputs, labels)
+            with torch.autocast(self.device, dtype=self.autocast_dtype, enabled=self.use_autocast):
+                _, loss = model(inputs, labels)
             losses[k] = loss.item()
         loss = losses.mean()
         return loss
@@ -114,8 +119,7 @@ class Evaluator():
             print(f"Epoch {epoch}, step {iteration}, train loss {mean_loss_train:.4f}, evaluate loss {evaluate_loss:.4f}")
 
             # Let's generate a poem with a given title to see how the model is doing
-            test_tokens = torch.tensor(self.dataset.encode(self.test_input), dtype=torch.long, device=self.device).unsqueeze(0)
-            output = self.dataset.decode(model.generate(test_tokens, max_new_tokens=100)[0].tolist())
+            output = self.dataset.decode(model.generate(self.test_tokens, max_new_tokens=100)[0].tolist())
             # Truncate the output to the end-of-text character '\0'
             output = output[:output.find('\0')]
             print('Generate a complete poem for title 春夜喜雨:')
@@ -141,7 +145,8 @@ class Evaluator():
         # Evaluate the model by processing all batches generated by the generator
         for k, batch in enumerate(batch_generator):
             inputs, labels = batch
-            _, loss = model(inputs, labels)
+            with torch.autocast(self.device, dtype=self.autocast_dtype, enabled=self.use_autocast):
+                _, loss = model(inputs, labels)
             loss_sum += loss.item()
         loss = loss_sum / (k + 1)
         return loss
@@ -171,9 +176,8 @@ class Evaluator():
             print(f"Epoch {epoch}, step {iteration}, train loss {mean_loss_train:.4f}, evaluate loss {evaluate_loss:.4f}, train reward margin {mean_reward_margin_train:.4f}, evaluate reward margin {evaluate_reward_margin:.4f}")
 
             # Let's ask the two models to generate a poem respectively
-            test_tokens = torch.tensor(self.dataset.encode(self.test_input), dtype=torch.long, device=self.device).unsqueeze(0)
-            aligned_output = self.dataset.decode(dpo_wrapper.aligned_model.generate(test_tokens, max_new_tokens=100)[0].tolist())
-            reference_output = self.dataset.decode(dpo_wrapper.reference_model.generate(test_tokens, max_new_tokens=100)[0].tolist())
+            aligned_output = self.dataset.decode(dpo_wrapper.aligned_model.generate(self.test_tokens, max_new_tokens=100)[0].tolist())
+            reference_output = self.dataset.decode(dpo_wrapper.reference_model.generate(self.test_tokens, max_new_tokens=100)[0].tolist())
             # Truncate the output to the end-of-text character '\0'
             aligned_output = aligned_output[:aligned_output.find('\0')]
             reference_output = reference_output[:reference_output.find('\0')]
@@ -204,7 +208,8 @@ class Evaluator():
         batch_generator = self.dataset.get_batch_generator_alignment('evaluate')
         # Evaluate the model by processing all batches generated by the generator
         for k, (positive_inputs, positive_labels, negative_inputs, negative_labels) in enumerate(batch_generator):
-            loss, reward_margin = dpo_wrapper.forward(positive_inputs, positive_labels, negative_inputs, negative_labels)
+            with torch.autocast(self.device, dtype=self.autocast_dtype, enabled=self.use_autocast):
+                loss, reward_margin = dpo_wrapper.forward(positive_inputs, positive_labels, negative_inputs, negative_labels)
             loss_sum += loss.item()
             reward_margin_sum += reward_margin.item()
         loss = loss_sum / (k + 1)
@@ -1,114 +1,100 @@
 import copy
+from functools import cache, partial
 from typing import Optional
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 from torch import Tensor
 
 
-class AttentionHead(nn.Module):
+class MultiHeadAttention(nn.Module):
     """
-    Single head of self-attention.
+    Multi-head self-attention.
 
     This module computes the self-attention for a batch of sequences,
-    where each sequence is maximum `max_length` tokens long
-    and each token is a vector of dimension `dim_embed`.
+    where each token is a vector of dimension `dim_embed`.
     The attention mechanism refers to the famous transformer paper "Attention is All You Need".
-    """
-
-    def __init__(self, dim_embed: int, head_size: int, max_length: int) -> None:
-        """
-        Initialize the module with 3 linear layers and a mask buffer.
-
-        Args:
-            dim_embed: The dimension of each token vector in the input sequences.
-            head_size: The dimension of the output vectors.
-            max_length: The maximum length of any token sequence. Known as the maximum context length.
-        """
-        super().__init__()
-        # Create linear layers to project the input tensor to key tensor, query tensor, and value tensor.
-        # The 3 layers do the same transformation but they do not share weights.
-        # After training, the layers will learn different aspects of the input vectors.
-        self.project_to_key = nn.Linear(dim_embed, head_size, bias=False)
-        self.project_to_query = nn.Linear(dim_embed, head_size, bias=False)
-        self.project_to_value = nn.Linear(dim_embed, head_size, bias=False)
-        # Create a matrix buffer to mask a square matrix to a lower triangular matrix.
-        # This is used to add the causal constraint to the self-attention mechanism,
-        # which means that each token can only see the previous tokens but not the future tokens.
-        self.register_buffer('tril', torch.tril(torch.ones(max_length, max_length)))
 
-    def forward(self, input: Tensor) -> Tensor:
-        """
-        Compute the self-attention for the input tensor.
-
-        Args:
-            input: A tensor of shape (B, T, `dim_embed`) where B is the batch size,
-                T is the token sequence length, and `dim_embed` is the dimension of each token vector.
-
-        Returns:
-            A tensor of shape (B, T, `head_size`). Each vector in the input tensor is transformed
-            into a new vector of dimension `head_size` that captures the self-attention.
-        """
-        B, T, dim_embed = input.shape
-        # Project the input tensor to key tensor, query tensor, and value tensor
-        key = self.project_to_key(input)          # (B, T, dim_embed) -> (B, T, head_size)
-        query = self.project_to_query(input)      # (B, T, dim_embed) -> (B, T, head_size)
-        value = self.project_to_value(input)      # (B, T, dim_embed) -> (B, T, head_size)
-        # Compute the self-attention weights
-        weights = query @ key.transpose(-2, -1)   # (B, T, head_size) @ (B, head_size, T) -> (B, T, T)
-        # Scale the attention weights to
-        weights *= dim_embed ** -0.5
-        # Mask the attention weights to respect the causal constraint
-        # Slice the tril matrix to fit the size of the current input
-        weights = weights.masked_fill(self.tril[:T, :T] == 0, float('-inf'))
-        # Turn the attention weights into probabilities
-        weights = F.softmax(weights, dim=-1)
-        # Apply the attention to the values
-        output = weights @ value                  # (B, T, T) @ (B, T, head_size) -> (B, T, head_size)
-        return output
-
-class MultiHeadAttention(nn.Module):
-    """
-    Multi-head self-attention.
-
-    The multi-head self-attention is composed by aggregating the outputs of several `AttentionHead` modules.
+    All heads are computed together: a single linear layer projects the input to the keys, queries,
+    and values of every head at once, and the heads are kept as a separate tensor dimension
+    so that one batched matrix multiplication serves all of them.
     """
 
-    def __init__(self, dim_embed: int, num_heads: int, head_size: int, max_length: int) -> None:
+    def __init__(self, dim_embed: int, num_heads: int, head_size: int) -> None:
         """
-        Initialize the module with concatenated `AttentionHead`s and a projection layer.
+        Initialize the module with a fused key-query-value projection and a projection layer.
 
         Args:
             dim_embed: The dimension of each token vector in the input tensor.
             num_heads: The number of heads included in a multi-head attention.
             head_size: The dimension of the output vectors for each head.
-            max_length: The maximum length of any token sequence. Known as the maximum context length.
         """
         super().__init__()
-        # Create a list of `num_heads` attention heads
-        self.heads = nn.ModuleList([AttentionHead(dim_embed, head_size, max_length) for _ in range(num_heads)])
+        self.num_heads = num_heads
+        self.head_size = head_size
+        # Create a linear layer to project the input tensor to key tensor, query tensor, and value tensor of all heads.
+        # It is equivalent to 3 * `num_heads` separate linear layers that do not share weights, but runs as one
+        # matrix multiplication. After training, the weights will learn different aspects of the input vectors.
+        self.project_to_qkv = nn.Linear(dim_embed, 3 * num_heads * head_size, bias=False)
         # Create a linear layer to project the concatenated output of all heads to the original dimension.
         # In our case, the concatenated output is happen to be the same as the original dimension, so we can skip
         # this projection layer. But in general, the output of the heads may have different dimension than the input.
         self.project = nn.Linear(head_size * num_heads, dim_embed)
 
-    def forward(self, input: Tensor) -> Tensor:
+    def forward(self, input: Tensor, attention_bias: Tensor, past_key_value: Optional[tuple[Tensor, Tensor]] = None) -> tuple[Tensor, tuple[Tensor, Tensor]]:
         """
         Compute the multi-head self-attention for the input tensor.
 
         Args:
             input: A tensor of shape (B, T, `dim_embed`) where B is the batch size,
                 T is the token sequence length, and `dim_embed` is the dimension of each token vector.
+            attention_bias: A tensor of shape (T, T_past + T) added to the attention weights to apply the causal
+                constraint, where T_past is the number of cached tokens in `past_key_value`. It is 0 where an input
+                token can see the other token and -inf where it cannot.
+            past_key_value: The key tensor and value tensor of the preceding tokens, each of shape
+                (B, `num_heads`, T_past, `head_size`). If provided, the input tokens are treated as
+                the continuation of the preceding tokens and can attend to them.
 
         Returns:
             A tensor of shape (B, T, `dim_embed`). Each vector in the input tensor is transformed
             into a new vector of same dimension that captures the multi-head self-attention.
+            Also the key tensor and value tensor of all tokens so far, to be passed as `past_key_value`
+            when computing the following tokens.
         """
-        # Send the input tensor to each attention head and concatenate the outputs
-        output = torch.cat([head(input) for head in self.heads], dim=-1)    # (B, T, dim_embed) -> [(B, T, head_size)] * num_heads -> (B, T, head_size * num_heads)
+        B, T, dim_embed = input.shape
+        H, D = self.num_heads, self.head_size
+        # Project the input tensor to key tensor, query tensor, and value tensor of all heads at once
+        qkv = self.project_to_qkv(input).view(B, T, 3, H, D)   # (B, T, dim_embed) -> (B, T, 3, H, D)
+        # Move the heads in front of the sequence so that each head is an independent batch of sequences
+        query, key, value = qkv.permute(2, 0, 3, 1, 4)          # (B, T, 3, H, D) -> 3 * (B, H, T, D)
+        # Prepend the cached keys and values of the preceding tokens
+        if past_key_value is not None:
+            past_key, past_value = past_key_value
+            key = torch.cat((past_key, key), dim=-2)            # (B, H, T_past, D) + (B, H, T, D) -> (B, H, T_past + T, D)
+            value = torch.cat((past_value, value), dim=-2)      # (B, H, T_past, D) + (B, H, T, D) -> (B, H, T_past + T, D)
+        if input.is_cuda:
+            # On GPU, let PyTorch dispatch to a fused attention kernel (e.g. FlashAttention). It applies the same
+            # scaling, causal mask and softmax as below, but never materializes the (T, T) attention weights.
+            if past_key_value is None:
+                output = F.scaled_dot_product_attention(query, key, value, is_causal=True, scale=dim_embed ** -0.5)
+            else:
+                output = F.scaled_dot_product_attention(query, key, value, attn_mask=attention_bias.to(query.dtype), scale=dim_embed ** -0.5)
+        else:
+            # Compute the self-attention weights
+            weights = query @ key.transpose(-2, -1)             # (B, H, T, D) @ (B, H, D, T_past + T) -> (B, H, T, T_past + T)
+            # Scale the attention weights, and mask them to respect the causal constraint by adding
+            # -inf to the weights of the tokens that cannot be seen
+            weights = weights * dim_embed ** -0.5 + attention_bias
+            # Turn the attention weights into probabilities
+            weights = F.softmax(weights, dim=-1)
+            # Apply the attention to the values
+            output = weights @ value                            # (B, H, T, T_past + T) @ (B, H, T_past + T, D) -> (B, H, T, D)
+        # Concatenate the outputs of all heads
+        output = output.transpose(1, 2).reshape(B, T, H * D)    # (B, H, T, D) -> (B, T, H, D) -> (B, T, H * D)
         # Project the concatenated output to the original dimension
-        output = self.project(output)                                       # (B, T, head_size * num_heads) -> (B, T, dim_embed)
-        return output
+        output = self.project(output)                           # (B, T, H * D) -> (B, T, dim_embed)
+        return output, (key, value)
 
 class FeedForward(nn.Module):
     """
@@ -131,10 +117,11 @@ class FeedForward(nn.Module):
         # Create a sequential module with 2 linear layers and a ReLU activation function.
         # The first layer scales up the input dimension by 4 times. Then the ReLU activation
         # function is applied to the output. Finally, the second layer scales down the
-        # dimension back to the original size.
+        # dimension back to the original size. The ReLU works in place since the output of the
+        # first layer is not needed anymore, which saves allocating another tensor of 4 times the size.
         self.feed_forward = nn.Sequential(
             nn.Linear(dim_embed, 4 * dim_embed),
-            nn.ReLU(),
+            nn.ReLU(inplace=True),
             nn.Linear(4 * dim_embed, dim_embed)
         )
 
@@ -157,7 +144,7 @@ class TranformerBlock(nn.Module):
     sub-module to stabilize the training process.
     """
 
-    def __init__(self, dim_embed: int, num_heads: int, max_length: int) -> None:
+    def __init__(self, dim_embed: int, num_heads: int) -> None:
         """
         Initialize the module with a multi-head self-attention, a feed-forward neural network,
         and 2 layer normalization layers.
@@ -165,20 +152,19 @@ class TranformerBlock(nn.Module):
         Args:
             dim_embed: The dimension of each token vector in the input tensor.
             num_heads: The number of heads included in a multi-head attention.
-            max_length: The maximum length of any token sequence. Known as the maximum context length.
         """
         super().__init__()
         # We choose the `head_size` as a divisor of `dim_embed` for simplicity.
         head_size = dim_embed // num_heads
         # Create a multi-head self-attention module
-        self.multi_head_attention = MultiHeadAttention(dim_embed, num_heads, head_size, max_length)
+        self.multi_head_attention = MultiHeadAttention(dim_embed, num_heads, head_size)
         # Create a feed-forward neural network module
         self.feed_forward = FeedForward(dim_embed)
         # Create 2 layer normalization layers
         self.layer_norm1 = nn.LayerNorm(dim_embed)
         self.layer_norm2 = nn.LayerNorm(dim_embed)
 
-    def forward(self, input: Tensor) -> Tensor:
+    def forward(self, input: Tensor, attention_bias: Tensor, past_key_value: Optional[tuple[Tensor, Tensor]] = None) -> tuple[Tensor, tuple[Tensor, Tensor]]:
         """
         Compute the output of the transformer block for the input tensor.
 
@@ -188,16 +174,20 @@ class TranformerBlock(nn.Module):
         Args:
             input: A tensor of shape (B, T, `dim_embed`) where B is the batch size,
                 T is the token sequence length, and `dim_embed` is the dimension of each token vector.
+            attention_bias: A tensor of 0 and -inf added to the attention weights to apply the causal constraint.
+            past_key_value: The cached key tensor and value tensor of the preceding tokens in this block.
 
         Returns:
             A tensor of shape (B, T, `dim_embed`). Each vector in the input tensor is transformed
             into a new vector of same dimension that captures the transformer mechanism.
+            Also the key tensor and value tensor of all tokens so far in this block.
         """
         # Apply the multi-head self-attention and add to the input tensor as a residual stream
-        output = input + self.multi_head_attention(self.layer_norm1(input)) # (B, T, dim_embed) + (B, T, dim_embed) -> (B, T, dim_embed)
+        attention, present_key_value = self.multi_head_attention(self.layer_norm1(input), attention_bias, past_key_value)
+        output = input + attention                                          # (B, T, dim_embed) + (B, T, dim_embed) -> (B, T, dim_embed)
         # Apply the feed-forward neural network and add to the output tensor as a residual stream
         output = output + self.feed_forward(self.layer_norm2(output))       # (B, T, dim_embed) + (B, T, dim_embed) -> (B, T, dim_embed)
-        return output
+        return output, present_key_value
 
 class TutorialLLM(nn.Module):
     """
@@ -207,7 +197,7 @@ class TutorialLLM(nn.Module):
     It resembles the GPT-2 model but used for educational purposes only.
     """
 
-    def __init__(self, vocabulary_size: int, dim_embed: int, max_length: int, num_head: int, num_layer: int, device: str) -> None:
+    def __init__(self, vocabulary_size: int, dim_embed: int, max_length: int, num_head: int, num_layer: int, device: str, loss_chunk_length: int = 64) -> None:
         """
         Initialize the model with a token embedding table, a position embedding table,
         several transformer blocks, a final layer normalization layer, and a linear layer.
@@ -218,97 +208,241 @@ class TutorialLLM(nn.Module):
             max_length: The maximum length of a text to be processed. Known as the maximum context length.
             num_head: The number of heads in the multi-head attention.
             num_layer: The number of transformer blocks in the model.
-            device: The device to run the model on, either 'cpu' or 'cuda'.
+            device: Unused, kept for existing callers. The model runs on the device it is moved to with `to`.
+            loss_chunk_length: The number of tokens per sequence whose logits are computed at a time for the loss.
+                A smaller value reduces the peak memory of the loss computation.
         """
         super().__init__()
         self.max_length = max_length
-        self.device = device
+        self.loss_chunk_length = loss_chunk_length
         # Create a token embedding table to convert token ids to vectors
         self.token_embedding_table = nn.Embedding(vocabulary_size, dim_embed)
         # Create a position embedding table to add positional information to the token vectors
         self.position_embedding_table = nn.Embedding(max_length, dim_embed)
+        # Create a buffer of all position ids to be sliced in each forward pass instead of creating them every time
+        self.register_buffer('position_ids', torch.arange(max_length), persistent=False)
+        # Create a matrix buffer that is 0 in the lower triangle and -inf above it. Adding it to the attention
+        # weights adds the causal constraint to the self-attention mechanism,
+        # which means that each token can only see the previous tokens but not the future tokens.
+        # The buffer is shared by all attention heads in all transformer blocks.
+        attention_bias = torch.zeros(max_length, max_length)
+        attention_bias.masked_fill_(torch.tril(torch.ones(max_length, max_length)) == 0, float('-inf'))
+        self.register_buffer('attention_bias', attention_bias, persistent=False)
         # Create a series of transformer blocks
-        self.transformer_blocks = nn.Sequential(*[TranformerBlock(dim_embed, num_head, max_length) for _ in range(num_layer)])
+        self.transformer_blocks = nn.Sequential(*[TranformerBlock(dim_embed, num_head) for _ in range(num_layer)])
         # Create a layer normalization layer for the final output
         self.layer_norm_final = nn.LayerNorm(dim_embed)
         # Create a linear layer to project the output from embedding space to vocabulary space
         self.project = nn.Linear(dim_embed, vocabulary_size)
 
-    def forward(self, token_ids: Tensor, labels: Tensor = None, reduce_loss: bool = True) -> tuple[Tensor, Optional[Tensor]]:
+    def forward(self, token_ids: Tensor, labels: Tensor = None, reduce_loss: bool = True) -> tuple[Optional[Tensor], Optional[Tensor]]:
         """
         Compute the forward pass of the model.
 
+        When the labels are provided, the loss is computed chunk by chunk along the sequence, so the logits
+        of all tokens in the batch are never materialized at once. Only the loss is returned in this case.
+
         Args:
             token_ids: A tensor of shape (B, T) where B is the batch size and T is the token sequence length.
                 The tensor contains the token ids of the input sequences.
             labels: A tensor of shape (B, T) where B is the batch size and T is the token sequence length.
                 The tensor contains the groundtruth token ids of the target sequences. If None, the model
                 will not compute the loss.
+            reduce_loss: Whether to average the loss over all tokens. If False, the loss of each token
+                is returned as a tensor of shape (B * T).
+
+        Returns:
+            The logits of the model if the labels are not provided, otherwise the loss. The other value is None.
+        """
+        # Run the model on the whole sequence, the key-value cache is only useful for generation
+        embedding, _ = self.transform(token_ids)                # (B, T) -> (B, T, dim_embed)
+
+        if labels is None:
+            # Project the output to the vocabulary space
+            logits = self.project(embedding)                    # (B, T, dim_embed) -> (B, T, vocabulary_size)
+            loss = None
+        else:
+            logits = None
+            B, T, _ = embedding.shape
+            # Compute the loss of `loss_chunk_length` tokens at a time, so that only the logits of one chunk exist
+            # at any time. When training, the logits of each chunk are recomputed in the backward pass instead of
+            # being kept in memory.
+            chunk_losses = []
+            for start in range(0, T, self.loss_chunk_length):
+                end = start + self.loss_chunk_length
+                if torch.is_grad_enabled():
+                    chunk_loss = checkpoint(self.compute_loss, embedding[:, start:end], labels[:, start:end], use_reentrant=False)
+                else:
+                    chunk_loss = self.compute_loss(embedding[:, start:end], labels[:, start:end])
+                chunk_losses.append(chunk_loss)
+            # Put the losses of all chunks back in order and flatten them to a list of token losses
+            loss = torch.cat(chunk_losses, dim=1).reshape(B * T)   # [(B, chunk)] -> (B, T) -> (B * T)
+            if reduce_loss:
+                # Average over the tokens with a label, the tokens labeled -100 are ignored
+                loss = loss.sum() / (labels != -100).sum()
+
+        return logits, loss
+
+    def compute_loss(self, embedding: Tensor, labels: Tensor) -> Tensor:
+        """
+        Compute the cross-entropy loss of each token.
+
+        Args:
+            embedding: A tensor of shape (B, T, `dim_embed`), the final output of the transformer.
+            labels: A tensor of shape (B, T) with the groundtruth token ids. Tokens labeled -100 are ignored.
+
+        Returns:
+            A tensor of shape (B, T) with the loss of each token, where the ignored tokens have zero loss.
+        """
+        # Project the output to the vocabulary space
+        logits = self.project(embedding)                        # (B, T, dim_embed) -> (B, T, vocabulary_size)
+        B, T, vocabulary_size = logits.shape
+        # Flatten the logits to a list of vectors in the vocabulary space
+        logits = logits.reshape(B * T, vocabulary_size)
+        # Flatten the labels to a list of token ids
+        labels = labels.reshape(B * T)
+        # Compute the cross-entropy loss between the logits and the labels
+        loss = F.cross_entropy(logits, labels, reduction='none')
+        return loss.view(B, T)
+
+    def transform(self, token_ids: Tensor, past_key_values: Optional[list[tuple[Tensor, Tensor]]] = None) -> tuple[Tensor, list[tuple[Tensor, Tensor]]]:
+        """
+        Compute the final output of the transformer in the embedding space, reusing the keys and values of the preceding tokens.
+
+        Args:
+            token_ids: A tensor of shape (B, T) where B is the batch size and T is the token sequence length.
+                The tensor contains the token ids that follow the cached tokens.
+            past_key_values: The key tensor and value tensor of the preceding tokens for each transformer block,
+                as returned by a previous call. If None, the token ids are the start of the sequences.
+                The cached and new tokens together must not exceed `max_length`.
 
         Returns:
-            The logits of the model and the loss if the labels are provided.
+            The output of shape (B, T, `dim_embed`) and the key tensor and value tensor of all tokens so far
+            for each transformer block.
         """
         B, T = token_ids.shape
-        # Get the token embedding and position embedding
+        past_length = 0 if past_key_values is None else past_key_values[0][0].shape[-2]
+        # Get the token embedding and position embedding. The new tokens are placed right after the cached tokens.
         token_embedding = self.token_embedding_table(token_ids) # (B, T) -> (B, T, dim_embed)
-        position_embedding = self.position_embedding_table(torch.arange(T, device=self.device)) # (T) -> (T, dim_embed)
+        position_embedding = self.position_embedding_table(self.position_ids[past_length:past_length + T]) # (T) -> (T, dim_embed)
         # Add the token embedding and position embedding in the last dimension
         embedding = token_embedding + position_embedding        # (B, T, dim_embed) + (T, dim_embed) -> (B, T, dim_embed)
-        # Send the embedding through the transformer blocks
-        embedding = self.transformer_blocks(embedding)          # (B, T, dim_embed) -> (B, T, dim_embed)
+        # The new tokens are at positions [T_past, T_past + T) and can see all the tokens up to themselves
+        attention_bias = self.attention_bias[past_length:past_length + T, :past_length + T]
+        # Send the embedding through the transformer blocks and collect the keys and values of each block
+        present_key_values = []
+        for i, transformer_block in enumerate(self.transformer_blocks):
+            past_key_value = None if past_key_values is None else past_key_values[i]
+            embedding, present_key_value = transformer_block(embedding, attention_bias, past_key_value) # (B, T, dim_embed) -> (B, T, dim_embed)
+            present_key_values.append(present_key_value)
         # Apply layer normalization to the final output
         embedding = self.layer_norm_final(embedding)            # (B, T, dim_embed) -> (B, T, dim_embed)
-        # Project the output to the vocabulary space
-        logits = self.project(embedding)                        # (B, T, dim_embed) -> (B, T, vocabulary_size)
+        return embedding, present_key_values
 
-        if labels is None:
-            loss = None
-        else:
-            B, T, vocabulary_size = logits.shape
-            # Flatten the logits to a list of vectors in the vocabulary space
-            logits = logits.view(B * T, vocabulary_size)
-            # Flatten the labels to a list of token ids
-            labels = labels.view(B * T)
-            # Compute the cross-entropy loss between the logits and the labels
-            loss = F.cross_entropy(logits, labels, reduce=reduce_loss)
+    def forward_with_cache(self, token_ids: Tensor, past_key_values: Optional[list[tuple[Tensor, Tensor]]] = None, last_token_only: bool = False) -> tuple[Tensor, list[tuple[Tensor, Tensor]]]:
+        """
+        Compute the logits of the model, reusing the keys and values of the preceding tokens.
 
-        return logits, loss
+        Args:
+            token_ids: A tensor of shape (B, T) where B is the batch size and T is the token sequence length.
+                The tensor contains the token ids that follow the cached tokens.
+            past_key_values: The key tensor and value tensor of the preceding tokens for each transformer block,
+                as returned by a previous call. If None, the token ids are the start of the sequences.
+                The cached and new tokens together must not exceed `max_length`.
+            last_token_only: If True, only compute the logits of the last token, which is all that is needed
+                to predict the next token. This avoids projecting every token to the vocabulary space.
+
+        Returns:
+            The logits of shape (B, T, vocabulary_size), or (B, vocabulary_size) if `last_token_only` is True,
+            and the key tensor and value tensor of all tokens so far for each transformer block.
+        """
+        embedding, present_key_values = self.transform(token_ids, past_key_values) # (B, T) -> (B, T, dim_embed)
+        if last_token_only:
+            # Pick the output of the last token where the next token should be predicted
+            embedding = embedding[:, -1, :]                     # (B, T, dim_embed) -> (B, dim_embed)
+        # Project the output to the vocabulary space
+        logits = self.project(embedding)                        # (B, T, dim_embed) -> (B, T, vocabulary_size), or (B, dim_embed) -> (B, vocabulary_size) for the last token only
+        return logits, present_key_values
 
-    def generate(self, token_ids: Tensor, max_new_tokens: int) -> Tensor:
+    def generate(self, token_ids: Tensor, max_new_tokens: int, eos_check_interval: int = 16) -> Tensor:
         """
         Generate subsequent tokens given the input tokens.
 
+        The keys and values of the processed tokens are cached, so each step only runs the model
+        on the newly generated token. Generation stops once every sequence has produced the
+        end-of-sequence token, which is checked every `eos_check_interval` steps to avoid
+        waiting for the device at each step.
+
         Args:
             token_ids: A tensor of shape (B, T) where B is the batch size and T is the token sequence length.
                 The tensor contains the token ids of the input sequences.
             max_new_tokens: The maximum number of new tokens to generate.
+            eos_check_interval: The number of steps between two checks of the end-of-sequence token.
 
         Returns:
             A tensor of token ids of generated sequences.
         """
-        for _ in range(max_new_tokens):
-            # Crop the input sequence to if it exceeds the maximum length
-            token_ids_available = token_ids[:, -self.max_length:]   # (B, T) -> (B, T'), where T' = min(T, max_length)
-            # Run the model to get the logits
-            logits, _ = self(token_ids_available)                   # (B, T') -> (B, T', vocabulary_size)
-            # Pick the logits of the last token where the next token should be predicted
-            logits = logits[:, -1, :]                               # (B, T', vocabulary_size) -> (B, vocabulary_size)
-            # Apply softmax to get probabilities
-            probs = F.softmax(logits, dim=-1)                       # (B, vocabulary_size) -> (B, vocabulary_size)
-            # Sample the next token from the probability distribution
-            idx_next = torch.multinomial(probs, num_samples=1)      # (B, vocabulary_size) -> (B, 1)
-            # Append the next token to the input sequence for the next iteration
-            token_ids = torch.cat((token_ids, idx_next), dim=1)     # (B, T) + (B, 1) -> (B, T+1)
-            # Stop if the next token is the end-of-sequence token whose id is 0
-            if idx_next.item() == 0:
+        B, prompt_length = token_ids.shape
+        # Preallocate the output sequences and fill in the generated tokens step by step
+        output = torch.empty((B, prompt_length + max_new_tokens), dtype=token_ids.dtype, device=token_ids.device)
+        output[:, :prompt_length] = token_ids
+        length = prompt_length
+        # Track which sequences have produced the end-of-sequence token whose id is 0
+        finished = torch.zeros(B, dtype=torch.bool, device=token_ids.device)
+        # Crop the input sequence to if it exceeds the maximum length
+        next_token_ids = token_ids[:, -self.max_length:]            # (B, T) -> (B, T'), where T' = min(T, max_length)
+        past_key_values = None
+        # On GPU, run the steps through the compiled `forward_with_cache`, since the Python overhead of launching
+        # many small operations dominates when only one token is processed. On CPU, the eager version is faster.
+        forward_with_cache = partial(compile_forward_with_cache(), self) if token_ids.is_cuda else self.forward_with_cache
+        for step in range(max_new_tokens):
+            # Run the model to get the logits of the last token, only the tokens not cached yet are processed
+            logits, past_key_values = forward_with_cache(next_token_ids, past_key_values, last_token_only=True) # (B, T') -> (B, vocabulary_size)
+            # Sample the next token from the probability distribution softmax(logits) with the Gumbel-max trick:
+            # adding Gumbel noise -log(E), E ~ Exp(1), to the logits and taking the maximum picks each token with
+            # exactly its softmax probability, without computing the softmax.
+            gumbel_noise = -torch.empty_like(logits, dtype=torch.float).exponential_().log()
+            idx_next = (logits.float() + gumbel_noise).argmax(dim=-1, keepdim=True) # (B, vocabulary_size) -> (B, 1)
+            # Keep the finished sequences padded with the end-of-sequence token
+            idx_next = idx_next.masked_fill(finished.unsqueeze(-1), 0)
+            finished |= idx_next.squeeze(-1) == 0
+            # Write the next token after the current sequence for the next iteration
+            output[:, length:length + 1] = idx_next                 # (B, T) + (B, 1) -> (B, T+1)
+            length += 1
+            if past_key_values[0][0].shape[-2] < self.max_length:
+                # Only the next token needs to be processed, the others are cached
+                next_token_ids = idx_next
+            else:
+                # The context is full. Since the positions of all tokens shift by one when the first token
+                # is cropped, the cache is no longer valid and the cropped sequence has to be recomputed.
+                next_token_ids = output[:, length - self.max_length:length]
+                past_key_values = None
+            # Stop if all sequences have produced the end-of-sequence token
+            if (step + 1) % eos_check_interval == 0 and finished.all():
                 break
-        return token_ids
+        if finished.all():
+            # Drop the padding after the last end-of-sequence token
+            first_eos = (output[:, prompt_length:length] == 0).int().argmax(dim=-1)
+            length = prompt_length + int(first_eos.max()) + 1
+        return output[:, :length]
         
     def count_parameters(self):
         """
         Calculates the number of trainable parameters in the model.
         """
         return sum(p.numel() for p in self.parameters() if p.requires_grad)
+
+@cache
+def compile_forward_with_cache():
+    """
+    Compile `TutorialLLM.forward_with_cache` for `generate` on GPU.
+
+    The compilation is set up on the first call only, so importing this module or running on CPU
+    does not load the compiler. Dynamic shapes let the same graph serve all cache lengths instead
+    of recompiling for each one.
+    """
+    return torch.compile(TutorialLLM.forward_with_cache, dynamic=True)
+
 class DpoWrapper():
     """
     Direct Preference Optimization wrapper.
@@ -331,8 +465,12 @@ class DpoWrapper():
         self.beta = beta
         self.positive_weight = positive_weight
         self.negative_weight = 1 - positive_weight
-        # Clone the model to create a reference model for DPO
+        # Clone the model to create a reference model for DPO. The reference model is never trained,
+        # so freeze it and drop the gradients cloned from the finetuned model to save memory.
         self.reference_model = copy.deepcopy(model)
+        self.reference_model.requires_grad_(False)
+        self.reference_model.zero_grad(set_to_none=True)
+        self.reference_model.eval()
 
     def forward(self, positive_token_ids: Tensor, positive_labels: Tensor, negative_token_ids: Tensor, negative_labels: Tensor) -> tuple[Tensor, Tensor]:
         """
@@ -352,12 +490,16 @@ class DpoWrapper():
         Returns:
             The DPO loss and the reward margin.
         """
-        # Forward pass the positive and negative samples on aligned model and reference model
-        _, positive_loss = self.aligned_model(positive_token_ids, positive_labels, False)
-        _, negative_loss = self.aligned_model(negative_token_ids, negative_labels, False)
+        # Stack the positive and negative samples into one batch so that each model runs a single forward pass
+        token_ids = torch.cat((positive_token_ids, negative_token_ids), dim=0)    # 2 * (B, T) -> (2B, T)
+        labels = torch.cat((positive_labels, negative_labels), dim=0)              # 2 * (B, T) -> (2B, T)
+        # Forward pass the samples on aligned model and reference model, and split the losses back
+        # into the positive half and the negative half
+        _, loss = self.aligned_model(token_ids, labels, False)
+        positive_loss, negative_loss = loss.chunk(2)
         with torch.inference_mode():
-            _, reference_positive_loss = self.reference_model(positive_token_ids, positive_labels, False)
-            _, reference_negative_loss = self.reference_model(negative_token_ids, negative_labels, False)
+            _, reference_loss = self.reference_model(token_ids, labels, False)
+            reference_positive_loss, reference_negative_loss = reference_loss.chunk(2)
 
         # Implement the DPO(Direct Preference Optimiazation) loss
         positive_reward = reference_positive_loss - positive_loss
@@ -369,3 +511,20 @@ class DpoWrapper():
         reward_margin = self.positive_weight * positive_reward + self.negative_weight * negative_reward
         loss = - F.logsigmoid(self.beta * reward_margin).mean()
         return loss, reward_margin.mean()
+
+def get_autocast_config(device: str) -> tuple[bool, torch.dtype]:
+    """
+    Decide the mixed precision to train and evaluate the model with.
+
+    Mixed precision is only used on GPU. bfloat16 is preferred since it has the same range as float32,
+    and float16 is the fallback on GPUs without bfloat16 support.
+
+    Args:
+        device: The device to run the model on ('cpu' or 'cuda').
+
+    Returns:
+        Whether to enable autocast, and the data type to autocast to.
+    """
+    use_autocast = device == 'cuda'
+    autocast_dtype = torch.bfloat16 if use_autocast and torch.cuda.is_bf16_supported() else torch.float16
+    return use_autocast, autocast_dtype
@@ -35,6 +35,9 @@ model = TutorialLLM(dataset.vocabulary_size, dim_embedding, max_length, num_head
 # Switch the model to training mode and move the data to the specified device
 model.train()
 model.to(device)
+# Compile the model on GPU to fuse its many small operations into fewer kernels
+if device == 'cuda':
+    model.compile()
 # Show the model size
 print(f'Our model has {sum(parameter.numel() for parameter in model.parameters())/1e6} M parameters')
 # The number of iterations to evaluate the pretrain process (each iteration processes a batch)
@@ -0,0 +1,123 @@
+import os
+import sys
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from model import TutorialLLM
+
+def create_model(max_length: int = 16, loss_chunk_length: int = 64) -> TutorialLLM:
+    """
+    Create a small model on CPU with fixed random weights.
+    """
+    torch.manual_seed(2024)
+    model = TutorialLLM(50, 16, max_length, 4, 2, 'cpu', loss_chunk_length)
+    model.eval()
+    return model
+
+def test_forward_with_cache():
+    """
+    Test the logits computed token by token with the key-value cache match the logits of the full forward pass.
+    """
+    model = create_model()
+    token_ids = torch.randint(0, 50, (2, model.max_length))
+    with torch.no_grad():
+        expected_logits, _ = model(token_ids)
+        # Process a prompt of 5 tokens first, then the remaining tokens one by one
+        logits, past_key_values = model.forward_with_cache(token_ids[:, :5])
+        assert torch.allclose(logits, expected_logits[:, :5], atol=1e-5)
+        for t in range(5, model.max_length):
+            logits, past_key_values = model.forward_with_cache(token_ids[:, t:t + 1], past_key_values, last_token_only=True)
+            assert logits.shape == (2, 50)
+            assert torch.allclose(logits, expected_logits[:, t], atol=1e-5)
+        assert past_key_values[0][0].shape == (2, 4, model.max_length, 4)
+
+def test_generate_beyond_max_length():
+    """
+    Test generating more tokens than `max_length` gives the same tokens as running the full forward pass at each step.
+    """
+    model = create_model(max_length=8)
+    token_ids = torch.randint(1, 50, (1, 6))
+    max_new_tokens = 30
+    # Generate without key-value cache, sampling the same way as `generate`
+    torch.manual_seed(0)
+    expected = token_ids
+    with torch.no_grad():
+        for _ in range(max_new_tokens):
+            logits, _ = model(expected[:, -model.max_length:])
+            logits = logits[:, -1, :]
+            gumbel_noise = -torch.empty_like(logits).exponential_().log()
+            idx_next = (logits + gumbel_noise).argmax(dim=-1, keepdim=True)
+            expected = torch.cat((expected, idx_next), dim=1)
+            if idx_next.item() == 0:
+                break
+
+        torch.manual_seed(0)
+        output = model.generate(token_ids, max_new_tokens)
+    assert torch.equal(output, expected)
+
+def test_generate_stops_at_end_of_sequence():
+    """
+    Test a batch where sequences end at different steps is padded with the end-of-sequence token
+    and trimmed after the last one, and no tokens are generated when `max_new_tokens` is 0.
+    """
+    model = create_model()
+    # Make the model predict the end-of-sequence token 0 with probability 0.3 and token 1 otherwise
+    with torch.no_grad():
+        model.project.weight.zero_()
+        model.project.bias.fill_(-1e4)
+        model.project.bias[0] = torch.log(torch.tensor(0.3))
+        model.project.bias[1] = torch.log(torch.tensor(0.7))
+    token_ids = torch.randint(2, 50, (8, 3))
+    max_new_tokens = 100
+
+    torch.manual_seed(0)
+    with torch.no_grad():
+        output = model.generate(token_ids, max_new_tokens)
+        assert torch.equal(model.generate(token_ids, 0), token_ids)
+
+    assert torch.equal(output[:, :3], token_ids)
+    generated = output[:, 3:]
+    # All sequences have ended, and the output is trimmed long before `max_new_tokens`
+    assert generated.shape[1] < max_new_tokens
+    first_eos = (generated == 0).int().argmax(dim=-1)
+    assert (generated == 0).any(dim=-1).all()
+    # The output ends right after the last end-of-sequence token, and some sequences ended earlier
+    assert first_eos.max() == generated.shape[1] - 1
+    assert first_eos.min() < first_eos.max()
+    for row, eos in zip(generated, first_eos):
+        # Tokens before the end are sampled, tokens after it are padding
+        assert (row[:eos] == 1).all()
+        assert (row[eos:] == 0).all()
+
+def test_chunked_loss():
+    """
+    Test the loss computed chunk by chunk, and its gradients, match the cross-entropy loss of the full logits.
+    """
+    # The sequence length 20 is not a multiple of the chunk length 7
+    model = create_model(max_length=20, loss_chunk_length=7)
+    model.train()
+    token_ids = torch.randint(0, 50, (3, 20))
+    labels = torch.randint(0, 50, (3, 20))
+    labels[0, 12:] = -100
+    labels[2, 5:] = -100
+
+    def expected_loss(reduction: str) -> torch.Tensor:
+        embedding, _ = model.transform(token_ids)
+        logits = model.project(embedding)
+        return torch.nn.functional.cross_entropy(logits.reshape(-1, 50), labels.reshape(-1), reduction=reduction)
+
+    logits, loss = model(token_ids, labels)
+    assert logits is None
+    loss.backward()
+    gradients = [parameter.grad.clone() for parameter in model.parameters()]
+    model.zero_grad()
+    expected = expected_loss('mean')
+    expected.backward()
+    assert torch.allclose(loss, expected, atol=1e-6)
+    for gradient, parameter in zip(gradients, model.parameters()):
+        assert torch.allclose(gradient, parameter.grad, atol=1e-6)
+
+    _, loss = model(token_ids, labels, reduce_loss=False)
+    assert loss.shape == (3 * 20,)
+    assert torch.allclose(loss, expected_loss('none'), atol=1e-6)
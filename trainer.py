@@ -2,7 +2,7 @@ import torch
 
 from dataset import Dataset
 from evaluator import Evaluator
-from model import DpoWrapper, TutorialLLM
+from model import DpoWrapper, TutorialLLM, get_autocast_config
 
 
 class Trainer():
@@ -26,6 +26,9 @@ class Trainer():
         self.dataset = dataset
         self.evaluator = evaluator
         self.device = device
+        # Train with mixed precision on GPU, the same as the evaluator. Only float16 needs gradient scaling.
+        self.use_autocast, self.autocast_dtype = get_autocast_config(device)
+        self.use_grad_scaler = self.use_autocast and self.autocast_dtype == torch.float16
 
     def pretrain(self, iterations: int) -> None:
         """
@@ -38,25 +41,29 @@ class Trainer():
         """
         # Reset the evaluator to clear the loss history
         self.evaluator.reset()
-        # Initialize an optimizer with learning rate 1e-3
-        optimizer = torch.optim.AdamW(self.model.parameters(), lr=1e-3)
+        # Initialize an optimizer with learning rate 1e-3, fused into a single kernel on GPU
+        optimizer = torch.optim.AdamW(self.model.parameters(), lr=1e-3, fused=self.device == 'cuda')
+        # Initialize a gradient scaler to avoid float16 gradients underflowing, it does nothing if disabled
+        scaler = torch.amp.GradScaler(self.device, enabled=self.use_grad_scaler)
 
         for i in range(iterations):
             # Get a batch of pretrain data
             inputs, labels = self.dataset.get_batch_pretrain('train')
             # Forward pass and calculate the loss
-            _, loss = self.model(inputs, labels)
+            with torch.autocast(self.device, dtype=self.autocast_dtype, enabled=self.use_autocast):
+                _, loss = self.model(inputs, labels)
 
             # Evaluate the model performance
             self.evaluator.evaluate_pretrain(self.model, i, loss.item())
 
             # Backward pass and update the model
             optimizer.zero_grad(set_to_none=True)
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
         print('Save the pretrained model...')
-        torch.save(self.model, 'model_pretrain.pth')
+        torch.save(self.model.state_dict(), 'model_pretrain.pth')
 
     def finetune(self, epochs) -> None:
         """
@@ -67,26 +74,30 @@ class Trainer():
         Args:
             epochs: The number of epochs to finetune the model.
         """
-        # Initialize an optimizer with learning rate 1e-3
-        optimizer = torch.optim.AdamW(self.model.parameters(), lr=1e-3)
+        # Initialize an optimizer with learning rate 1e-3, fused into a single kernel on GPU
+        optimizer = torch.optim.AdamW(self.model.parameters(), lr=1e-3, fused=self.device == 'cuda')
+        # Initialize a gradient scaler to avoid float16 gradients underflowing, it does nothing if disabled
+        scaler = torch.amp.GradScaler(self.device, enabled=self.use_grad_scaler)
         
         for epoch in range(epochs):
             # Reset the evaluator to clear the loss history for each epoch
             self.evaluator.reset()
             for i, (inputs, labels) in enumerate(self.dataset.get_batch_generator_finetune('train')):
                 # Forward pass and calculate the loss
-                _, loss = self.model(inputs, labels)
+                with torch.autocast(self.device, dtype=self.autocast_dtype, enabled=self.use_autocast):
+                    _, loss = self.model(inputs, labels)
 
                 # Evaluate the model performance
                 self.evaluator.evaluate_finetune(self.model, epoch, i, loss.item())
 
                 # Backward pass and update the model
                 optimizer.zero_grad(set_to_none=True)
-                loss.backward()
-                optimizer.step()
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
 
         print('Save the finetuned model...')
-        torch.save(self.model, 'model_finetune.pth')
+        torch.save(self.model.state_dict(), 'model_finetune.pth')
 
     def align(self, epochs) -> None:
         """
@@ -99,22 +110,26 @@ class Trainer():
         """
         # The alignment needs a reference model for DPO, we use a DpoWrapper to manage the 2 models
         dpo_wrapper = DpoWrapper(self.model)
-        # Initialize an optimizer with learning rate 1e-5
-        optimizer = torch.optim.AdamW(self.model.parameters(), lr=1e-5)
+        # Initialize an optimizer with learning rate 1e-5, fused into a single kernel on GPU
+        optimizer = torch.optim.AdamW(self.model.parameters(), lr=1e-5, fused=self.device == 'cuda')
+        # Initialize a gradient scaler to avoid float16 gradients underflowing, it does nothing if disabled
+        scaler = torch.amp.GradScaler(self.device, enabled=self.use_grad_scaler)
 
         for epoch in range(epochs):
             # Reset the evaluator to clear the loss history for each epoch
             self.evaluator.reset()
             for i, (positive_inputs, positive_labels, negative_inputs, negative_labels) in enumerate(self.dataset.get_batch_generator_alignment('train')):
-                loss, reward_margin = dpo_wrapper.forward(positive_inputs, positive_labels, negative_inputs, negative_labels)
+                with torch.autocast(self.device, dtype=self.autocast_dtype, enabled=self.use_autocast):
+                    loss, reward_margin = dpo_wrapper.forward(positive_inputs, positive_labels, negative_inputs, negative_labels)
 
                 # Evaluate the model every evaluation_interval iterations
                 self.evaluator.evaluate_alignment(dpo_wrapper, epoch, i, loss.item(), reward_margin.item())
 
                 # Backward pass and update the model
                 optimizer.zero_grad(set_to_none=True)
-                loss.backward()
-                optimizer.step()
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
 
         print('Save the aligned model...')
-        torch.save(self.model, 'model_aligned.pth')
\ No newline at end of file
+        torch.save(self.model.state_dict(), 'model_aligned.pth')
\ No newline at end of file